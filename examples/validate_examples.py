@@ -1,68 +1,172 @@
 # Validation script to ensure that the examples validate against the defined schema.
 # See Dockerfile to run this script with Docker rather than setting up an environment with requirements.txt.
 
+import copy
 import os.path
-from dataclasses import dataclass
+import functools
 import json
 from pathlib import Path
 import sys
-from typing import List, Optional
+from typing import Callable, Iterator, List, Optional, Set, Tuple
+import urllib.parse
+import urllib.request
 
 import bc_jsonpath_ng
+import fastjsonschema
 import jsonschema.validators
+from referencing import Registry, Resource
+from referencing.jsonschema import DRAFT7
 
+from validate_examples_core import ValidationError, collect_errors
 
-@dataclass
-class ValidationError(object):
-    """Error encountered while validating an instance against a schema."""
 
-    message: str
-    """Validation error message."""
+@functools.lru_cache(maxsize=None)
+def _parse_jsonpath(path: str):
+    return bc_jsonpath_ng.parse(path)
 
-    json_path: str
-    """Location of the data causing the validation error."""
 
-
-def _collect_errors(e: jsonschema.ValidationError) -> List[ValidationError]:
-    if e.context:
-        result = []
-        for child in e.context:
-            result.extend(_collect_errors(child))
-        return result
+def _find_single_match(path: str, content, content_description: str) -> bc_jsonpath_ng.DatumInContext:
+    matches = _parse_jsonpath(path).find(content)
+    if len(matches) != 1:
+        raise ValueError(
+            f"Found {len(matches)} matches to JSON path '{path}' within {content_description} when expecting exactly 1 match"
+        )
+    return matches[0]
+
+
+def _find_single(path: str, content, content_description: str):
+    if path == "$":
+        return content
+    return _find_single_match(path, content, content_description).value
+
+
+def _json_pointer(path: bc_jsonpath_ng.JSONPath) -> str:
+    """Convert the concrete path of a JSONPath match into a URI-fragment-encoded JSON Pointer."""
+    if isinstance(path, bc_jsonpath_ng.Child):
+        return _json_pointer(path.left) + _json_pointer(path.right)
+    elif isinstance(path, bc_jsonpath_ng.Fields) and len(path.fields) == 1:
+        token = path.fields[0].replace("~", "~0").replace("/", "~1")
+        return "/" + urllib.parse.quote(token, safe="~")
+    elif isinstance(path, bc_jsonpath_ng.Index):
+        return f"/{path.index}"
+    elif isinstance(path, (bc_jsonpath_ng.Root, bc_jsonpath_ng.This)):
+        return ""
     else:
-        return [ValidationError(message=e.message, json_path=e.json_path)]
+        raise ValueError(f"Cannot express JSON path '{path}' as a JSON Pointer")
 
 
-def validate(schema_path: str, object_path: str, instance: dict, instance_path: Optional[str] = None) -> List[ValidationError]:
-    with open(schema_path, "r") as f:
-        schema_content = json.load(f)
+@functools.lru_cache(maxsize=None)
+def _load_json(path: str) -> dict:
+    """Load and cache the JSON content at path; callers must not mutate the shared result."""
+    with open(path, "rb") as f:
+        return json.loads(f.read())
 
-    schema_matches = bc_jsonpath_ng.parse(object_path).find(schema_content)
-    if len(schema_matches) != 1:
-        raise ValueError(
-            f"Found {len(schema_matches)} matches to JSON path '{object_path}' within OpenAPI definition when expecting exactly 1 match"
+
+def _load_local_ref(uri: str) -> dict:
+    # fastjsonschema rewrites $refs in place, so it must not be given the cached content
+    return copy.deepcopy(_load_json(os.path.realpath(urllib.request.url2pathname(urllib.parse.urlparse(uri).path))))
+
+
+@functools.lru_cache(maxsize=None)
+def _schema_uri(path: str) -> str:
+    return Path(path).as_uri()
+
+
+_FASTJSONSCHEMA_VALIDATORS = (jsonschema.Draft4Validator, jsonschema.Draft6Validator, jsonschema.Draft7Validator)
+"""jsonschema validator classes for drafts that fastjsonschema compiles with the same semantics."""
+
+
+_checked_schemas: Set[int] = set()
+"""Identities of (cached, shared) schema objects that have already passed check_schema."""
+
+
+@functools.lru_cache(maxsize=None)
+def _build_registry(schema_dir: str) -> Registry:
+    """Build a registry containing every schema file in schema_dir, keyed by file URI."""
+    resources = []
+    for schema_file in sorted(Path(schema_dir).glob("*.json")):
+        schema_file_path = os.path.realpath(schema_file)
+        content = _load_json(schema_file_path)
+        resources.append((_schema_uri(schema_file_path), Resource.from_contents(content, default_specification=DRAFT7)))
+    return Registry().with_resources(resources)
+
+
+@functools.lru_cache(maxsize=None)
+def build_validator(schema_path: str, object_path: str) -> Tuple[jsonschema.protocols.Validator, Optional[Callable[[dict], dict]]]:
+    """Construct validators for the schema at object_path within schema_path.
+
+    Results are cached so that examples sharing a schema reuse the same validators.  The fastjsonschema-compiled
+    function is a quick validity check; the jsonschema validator is used to enumerate errors when that check fails.
+    No compiled function is returned for drafts fastjsonschema does not support.
+    """
+    schema_path = os.path.realpath(schema_path)
+    schema_content = _load_json(schema_path)
+
+    if object_path == "$":
+        schema = schema_content
+    else:
+        match = _find_single_match(object_path, schema_content, "OpenAPI definition")
+        schema = match.value
+
+    validator_class = jsonschema.validators.validator_for(schema)
+    if id(schema) not in _checked_schemas:
+        validator_class.check_schema(schema)
+        _checked_schemas.add(id(schema))
+
+    if object_path == "$":
+        # Relative $refs are resolved against $id, so give the schema its file location as a base URI
+        root_schema = {"$id": _schema_uri(schema_path), **schema}
+    else:
+        # Refer to the sub-schema within its file so that its $refs resolve against the whole document
+        root_schema = {"$ref": f"{_schema_uri(schema_path)}#{_json_pointer(match.full_path)}"}
+    validator = validator_class(root_schema, registry=_build_registry(os.path.dirname(schema_path)))
+
+    if validator_class in _FASTJSONSCHEMA_VALIDATORS:
+        # fastjsonschema takes the draft from the root $schema, so pin it to the draft jsonschema validates with
+        compiled: Optional[Callable[[dict], dict]] = fastjsonschema.compile(
+            copy.deepcopy({**root_schema, "$schema": validator_class.META_SCHEMA["$schema"]}),
+            handlers={"file": _load_local_ref},
+            use_default=False,
+            use_formats=False,
         )
-    schema = schema_matches[0].value
+    else:
+        compiled = None
+    return validator, compiled
+
 
+def _iter_errors(
+    validator: jsonschema.protocols.Validator, value, compiled: Optional[Callable[[dict], dict]]
+) -> Iterator[ValidationError]:
+    if compiled is not None:
+        try:
+            compiled(value)
+            return
+        except fastjsonschema.JsonSchemaException:
+            # The compiled validator stops at the first error; fall through to report all of them
+            pass
+
+    for e in validator.iter_errors(value):
+        yield from collect_errors(e)
+
+
+def run_validator(
+    validator: jsonschema.protocols.Validator,
+    instance: dict,
+    instance_path: Optional[str] = None,
+    compiled: Optional[Callable[[dict], dict]] = None,
+) -> Iterator[ValidationError]:
+    # Resolve the value eagerly so that a bad instance_path fails at call time rather than on iteration
     if instance_path is not None:
-        instance_matches = bc_jsonpath_ng.parse(instance_path).find(instance)
-        if len(instance_matches) != 1:
-            raise ValueError(
-                f"Found {len(instance_matches)} matches to JSON path '{instance_path}' within value to validate when expecting exactly 1 match"
-            )
-        value = instance_matches[0].value
+        value = _find_single(instance_path, instance, "value to validate")
     else:
         value = instance
 
-    validator_class = jsonschema.validators.validator_for(schema)
-    validator_class.check_schema(schema)
+    return _iter_errors(validator, value, compiled)
 
-    ref_resolver = jsonschema.RefResolver(f"{Path(schema_path).as_uri()}", schema_content)
-    validator = validator_class(schema, resolver=ref_resolver)
-    result = []
-    for e in validator.iter_errors(value):
-        result.extend(_collect_errors(e))
-    return result
+
+def validate(schema_path: str, object_path: str, instance: dict, instance_path: Optional[str] = None) -> Iterator[ValidationError]:
+    validator, compiled = build_validator(schema_path, object_path)
+    return run_validator(validator, instance, instance_path, compiled)
 
 
 def main() -> bool:
@@ -88,22 +192,26 @@ def main() -> bool:
     for example, example_jsonpath, schema_file, schema_jsonpath, should_validate in to_validate:
         schema_path = os.path.join(root, "schema", schema_file + ".json")
         instance_path = os.path.join(root, "examples", example + ".json")
-        with open(instance_path, "r") as f:
-            instance_content = json.load(f)
+        with open(instance_path, "rb") as f:
+            instance_content = json.loads(f.read())
 
-        errors = validate(schema_path, schema_jsonpath, instance_content, example_jsonpath)
+        validator, compiled = build_validator(schema_path, schema_jsonpath)
+        errors = run_validator(validator, instance_content, example_jsonpath, compiled)
         if should_validate:
-            if errors:
-                print(f"{example}: {len(errors)} errors found")
-                for e in errors:
+            error_list = list(errors)
+            if error_list:
+                print(f"{example}: {len(error_list)} errors found")
+                for e in error_list:
                     print(f"  * {e.json_path}: {e.message}")
                     print()
                 success = False
             else:
                 print(f"{example}: No errors found.")
         else:
-            if errors:
-                print(f"{example}: Correctly found {len(errors)} errors.")
+            # Only the number of errors is reported here, so count them without keeping them
+            error_count = sum(1 for _ in errors)
+            if error_count:
+                print(f"{example}: Correctly found {error_count} errors.")
             else:
                 print(f"{example}: INCORRECTLY found no errors")
                 success = False
@@ -0,0 +1,29 @@
+# Error-collection helpers for validate_examples.py, kept free of dynamic typing so they can be compiled with mypyc:
+#   mypyc --ignore-missing-imports validate_examples_core.py
+# validate_examples.py imports the compiled extension when it is present, and this source module otherwise.
+
+from typing import Iterator, List, NamedTuple
+
+import jsonschema
+
+
+class ValidationError(NamedTuple):
+    """Error encountered while validating an instance against a schema."""
+
+    message: str
+    """Validation error message."""
+
+    json_path: str
+    """Location of the data causing the validation error."""
+
+
+def collect_errors(e: jsonschema.ValidationError) -> Iterator[ValidationError]:
+    """Yield the leaf errors beneath e, in depth-first order."""
+    stack: List[jsonschema.ValidationError] = [e]
+    while stack:
+        error = stack.pop()
+        if error.context:
+            # Push children in reverse so they are visited in their original order
+            stack.extend(reversed(error.context))
+        else:
+            yield ValidationError(message=error.message, json_path=error.json_path)